@@ -1,19 +1,36 @@
+import os
+import re
+import sys
+import json
 import pickle
-import base64
 import asyncio
 import logging
 import hashlib
 import mimetypes
 import uuid
-import threading
+import weakref
 import copy
+import itertools
 from dataclasses import dataclass
-from abc import ABC, abstractmethod
-from typing import List, Dict, Any, Optional, Union, Callable
+from typing import List, Dict, Any, Optional, Union, Callable, Iterable, Tuple
+
+def enable_uvloop() -> bool:
+    """
+    Installs uvloop as the asyncio event loop policy if it is available.
+    This is opt-in so that embedding applications keep control of their event loop.
+    Returns True if uvloop was installed, False if it is not importable.
+    """
+    try:
+        import uvloop
+    except ImportError:
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
 
 # A wrapper to manage multiple providers with the same name
 class ProviderGroup:
     """A container for multiple providers that share the same name, allowing for bulk operations."""
+    __slots__ = ('_providers',)
     def __init__(self, providers: List['ContextProvider']):
         self._providers = providers
     def __getitem__(self, key: int) -> 'ContextProvider':
@@ -35,35 +52,104 @@ class ProviderGroup:
         for p in self._providers:
             p.visible = value
 
-# Global, thread-safe registry for providers created within f-strings
+# Global registry for providers created within f-strings. Ids are unique, and a single
+# dict store or pop is atomic, so no lock is needed even across threads (placeholders
+# may be formatted on one thread and parsed into a Message on another).
 _fstring_provider_registry = {}
-_registry_lock = threading.Lock()
+# Placeholder ids are a per-process random prefix plus a counter: unique without
+# an os.urandom call per f-string, and still not guessable from outside the process.
+_placeholder_prefix = uuid.uuid4().hex[:16]
+_placeholder_counter = itertools.count()
 
 def _register_provider(provider: 'ContextProvider') -> str:
     """Registers a provider and returns a unique placeholder."""
-    with _registry_lock:
-        provider_id = f"__provider_placeholder_{uuid.uuid4().hex}__"
-        _fstring_provider_registry[provider_id] = provider
-        return provider_id
+    provider_id = f"__provider_placeholder_{_placeholder_prefix}{next(_placeholder_counter):016x}__"
+    _fstring_provider_registry[provider_id] = provider
+    return provider_id
+
+# Weak cache behind Texts.get(); entries vanish once no message holds the provider.
+_texts_cache: 'weakref.WeakValueDictionary[tuple, Texts]' = weakref.WeakValueDictionary()
+
+# Attribute values Texts.__deepcopy__ can share between the original and the copy.
+_IMMUTABLE_TYPES = frozenset({str, bool, int, float, type(None), frozenset})
+
+_PLACEHOLDER_MARKER = "__provider_placeholder_"
+_PLACEHOLDER_PATTERN = re.compile(r'(__provider_placeholder_[a-f0-9]{32}__)')
 
 def _retrieve_provider(placeholder: str) -> Optional['ContextProvider']:
     """Retrieves a provider from the registry."""
-    with _registry_lock:
-        return _fstring_provider_registry.pop(placeholder, None)
+    return _fstring_provider_registry.pop(placeholder, None)
+
+# Bytes read per step when encoding images; a multiple of 3 so every chunk
+# base64-encodes without padding and the pieces concatenate cleanly.
+_BASE64_CHUNK_SIZE = 57 * 1024
+
+# Bytes read per step when Files only needs the first few lines of a file.
+_HEAD_CHUNK_SIZE = 64 * 1024
+
+# pybase64 (from the "speedups" extra) provides a SIMD codec with the same API.
+try:
+    from pybase64 import b64encode as _b64encode
+except ImportError:
+    from base64 import b64encode as _b64encode
+
+# orjson (from the "speedups" extra) is used for Messages.save/load when installed.
+try:
+    import orjson as _orjson
+except ImportError:
+    _orjson = None
+
+def _json_dumps(data: Any) -> bytes:
+    if _orjson is not None:
+        return _orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def _json_loads(data: bytes) -> Any:
+    if _orjson is not None:
+        return _orjson.loads(data)
+    return json.loads(data)
+
+def _is_plain_json(value: Any) -> bool:
+    """Whether value survives a JSON round trip unchanged (no tuples, sets or non-str keys)."""
+    if value is None or type(value) in (str, int, bool):
+        return True
+    if type(value) is float:
+        # NaN and infinities are not JSON; orjson writes them as null.
+        return value - value == 0.0
+    if type(value) is list:
+        return all(_is_plain_json(v) for v in value)
+    if type(value) is dict:
+        return all(type(k) is str and _is_plain_json(v) for k, v in value.items())
+    return False
 
 # 1. 核心数据结构: ContentBlock
-@dataclass
+@dataclass(slots=True)
 class ContentBlock:
     name: str
     content: str
 
 # 2. 上下文提供者 (带缓存)
-class ContextProvider(ABC):
-    def __init__(self, name: str, visible: bool = True):
-        self.name = name
+class ContextProvider:
+    # Runtime-only attributes that are dropped when pickling or deep-copying.
+    _TRANSIENT_ATTRS = ('_owners', '_refresh_task')
+
+    def __init__(self, name: str, visible: bool = True, tags: Optional[Iterable[str]] = None, swr: bool = False):
+        # Names are drawn from a small vocabulary and used as index keys; interning
+        # lets dict probes succeed on pointer equality.
+        self.name = sys.intern(name) if type(name) is str else name
+        # Free-form labels for bulk invalidation via Messages.invalidate_tags(); fixed after construction.
+        self.tags: frozenset = frozenset(tags or ())
         self._cached_content: Optional[str] = None
         self._is_stale: bool = True
         self._visible: bool = visible
+        # Stale-while-revalidate: refresh() keeps serving cached content and re-renders in the background.
+        self.swr: bool = swr
+        self._init_transient_state()
+
+    def _init_transient_state(self):
+        # Messages holding this provider, notified when its rendered output changes.
+        self._owners: 'weakref.WeakSet[Message]' = weakref.WeakSet()
+        self._refresh_task: Optional[asyncio.Task] = None
 
     def __str__(self):
         # This allows the object to be captured when used inside an f-string.
@@ -84,28 +170,73 @@ class ContextProvider(ABC):
             # Content needs to be re-evaluated, but the source data hasn't changed,
             # so just marking it stale is enough for the renderer to reconsider it.
             self.mark_stale()
+            self._notify_owners()
     async def refresh(self):
         if self._is_stale:
+            if self.swr and self._cached_content is not None:
+                if self._refresh_task is None or self._refresh_task.done():
+                    self._refresh_task = asyncio.create_task(self._revalidate())
+                    self._refresh_task.add_done_callback(self._log_revalidate_failure)
+                return
             self._cached_content = await self.render()
             self._is_stale = False
-    @abstractmethod
+            self._notify_owners()
+    async def _revalidate(self):
+        """Background half of stale-while-revalidate refreshes."""
+        # Cleared up front so a mark_stale() during render schedules another pass.
+        self._is_stale = False
+        try:
+            self._cached_content = await self.render()
+        except BaseException:
+            self._is_stale = True
+            raise
+        self._notify_owners()
+    def _log_revalidate_failure(self, task: asyncio.Task):
+        # Retrieving the exception here keeps it from surfacing only as
+        # "Task exception was never retrieved" when nobody awaits the task.
+        if not task.cancelled() and task.exception() is not None:
+            logging.error(f"Background refresh of provider '{self.name}' failed: {task.exception()}")
+    def _notify_owners(self):
+        """Invalidates the rendered cache of every message holding this provider."""
+        for message in self._owners:
+            message._invalidate()
+    def _needs_refresh(self) -> bool:
+        """Whether refresh() has any work to do, so containers can skip no-op refreshes."""
+        return self._is_stale
     async def render(self) -> Optional[str]: raise NotImplementedError
-    @abstractmethod
     def update(self, *args, **kwargs): raise NotImplementedError
+    def _rendered_text(self) -> Optional[str]:
+        """Visible cached content, without wrapping it in a ContentBlock."""
+        return self._cached_content if self._visible else None
     def get_content_block(self) -> Optional[ContentBlock]:
-        if self.visible and self._cached_content is not None:
-            return ContentBlock(self.name, self._cached_content)
+        content = self._rendered_text()
+        if content is not None:
+            return ContentBlock(self.name, content)
         return None
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # Owner back-references are rebuilt by the messages when they are restored.
+        for attr in self._TRANSIENT_ATTRS:
+            state.pop(attr, None)
+        return state
+
+    def __setstate__(self, state):
+        # Providers saved before tags and swr existed get the constructor defaults.
+        state.setdefault('tags', frozenset())
+        state.setdefault('swr', False)
+        self.__dict__.update(state)
+        self._init_transient_state()
+
     def __add__(self, other):
         if isinstance(other, Message):
             # Create a new message of the same type as `other`, with `self` prepended.
             new_items = [self] + other.provider()
-            return type(other)(*new_items)
+            return other._with_items(new_items)
         return NotImplemented
 
 class Texts(ContextProvider):
-    def __init__(self, text: Optional[Union[str, Callable[[], str]]] = None, name: Optional[str] = None, visible: bool = True, newline: bool = False):
+    def __init__(self, text: Optional[Union[str, Callable[[], str]]] = None, name: Optional[str] = None, visible: bool = True, newline: bool = False, tags: Optional[Iterable[str]] = None, swr: bool = False):
         if text is None and name is None:
             raise ValueError("Either 'text' or 'name' must be provided.")
         self.newline = newline
@@ -120,26 +251,51 @@ class Texts(ContextProvider):
 
         if name is None:
             if self._is_dynamic:
-                import uuid
-                _name = f"dynamic_text_{uuid.uuid4().hex[:8]}"
+                # The process prefix keeps names unique against providers loaded from
+                # files saved by another process, whose counter also started at 0.
+                _name = f"dynamic_text_{_placeholder_prefix}{next(_placeholder_counter):08x}"
             else:
-                # Handle the case where text is None during initialization
-                h = hashlib.sha1(self._text.encode() if self._text else b'').hexdigest()
-                _name = f"text_{h[:8]}"
+                _name = self._auto_name(self._text)
         else:
             _name = name
-        super().__init__(_name, visible=visible)
+        super().__init__(_name, visible=visible, tags=tags, swr=swr)
         if not self._is_dynamic:
             self._cached_content = self.content
             # The content is cached, but it's still "stale" from the perspective
             # of the async refresh cycle. Let the first refresh formalize it.
             self._is_stale = True
 
+    @staticmethod
+    def _auto_name(text: Optional[str]) -> str:
+        # Handle the case where text is None during initialization
+        h = hashlib.sha1(text.encode() if text else b'').hexdigest()
+        return f"text_{h[:8]}"
+
+    @classmethod
+    def get(cls, text: str) -> 'Texts':
+        """
+        Returns a shared static Texts for this string, creating it on first use.
+        Live instances are cached weakly, so repeated boilerplate (separators, system
+        prompts) reuses one provider. The instance is shared: calling update() or
+        changing visibility on it affects every message that holds it.
+        """
+        text = str(text)
+        key = (cls, text)
+        provider = _texts_cache.get(key)
+        if provider is None:
+            provider = cls(text)
+            _texts_cache[key] = provider
+        return provider
+
     async def refresh(self):
         if self._is_dynamic:
             self._is_stale = True
         await super().refresh()
 
+    def _needs_refresh(self) -> bool:
+        # Dynamic content must be re-evaluated on every refresh.
+        return self._is_dynamic or self._is_stale
+
     def update(self, text: Union[str, Callable[[], str]]):
         self._text = text
         self._is_dynamic = callable(self._text)
@@ -163,7 +319,7 @@ class Texts(ContextProvider):
 
     def __getstate__(self):
         """Custom state for pickling."""
-        state = self.__dict__.copy()
+        state = super().__getstate__()
         if self._is_dynamic:
             # For dynamic content, we snapshot its current value for serialization.
             # The lambda function itself cannot be pickled.
@@ -182,22 +338,29 @@ class Texts(ContextProvider):
     def __setstate__(self, state):
         """Custom state for unpickling."""
         # Just restore the dictionary. The transformation is one-way.
-        self.__dict__.update(state)
+        super().__setstate__(state)
 
     def __deepcopy__(self, memo):
         """Custom deepcopy to preserve dynamic content by copying the callable."""
         cls = self.__class__
         result = cls.__new__(cls)
         memo[id(self)] = result
+        transient = self._TRANSIENT_ATTRS
+        state = result.__dict__
         for k, v in self.__dict__.items():
-            setattr(result, k, copy.deepcopy(v, memo))
+            if k in transient:
+                continue
+            # Names, flags and cached strings are immutable; share them instead of
+            # going through the deepcopy dispatcher.
+            state[k] = v if type(v) in _IMMUTABLE_TYPES else copy.deepcopy(v, memo)
+        result._init_transient_state()
         return result
 
     def __eq__(self, other):
         if not isinstance(other, Texts):
             return NotImplemented
         # If either object is dynamic, they are only equal if they are the exact same object.
-        if self._is_dynamic or (hasattr(other, '_is_dynamic') and other._is_dynamic):
+        if self._is_dynamic or other._is_dynamic:
             return self is other
         # For static content, compare the actual content.
         return self.content == other.content
@@ -212,27 +375,40 @@ class Texts(ContextProvider):
     def __add__(self, other):
         if isinstance(other, str):
             # Create a new instance of the same class with the combined content
-            return type(self)(text=self.content + other, name=self.name, visible=self.visible, newline=self.newline)
+            combined = type(self)(text=self.content + other, name=self.name, visible=self.visible, newline=self.newline)
+            combined.tags = self.tags
+            combined.swr = self.swr
+            return combined
         elif isinstance(other, Message):
             new_items = [self] + other.provider()
-            return type(other)(*new_items)
+            return other._with_items(new_items)
         return NotImplemented
 
 class Tools(ContextProvider):
-    def __init__(self, tools_json: Optional[List[Dict]] = None, name: str = "tools", visible: bool = True):
-        super().__init__(name, visible=visible)
+    def __init__(self, tools_json: Optional[List[Dict]] = None, name: str = "tools", visible: bool = True, tags: Optional[Iterable[str]] = None, swr: bool = False):
+        super().__init__(name, visible=visible, tags=tags, swr=swr)
         self._tools_json = tools_json or []
+        self._serialized = self._serialize()
         # Pre-render and cache the content, but leave it stale for the first refresh
-        if self._tools_json:
-            self._cached_content = f"<tools>{str(self._tools_json)}</tools>"
+        self._cached_content = self._serialized
         self._is_stale = True
+    def _serialize(self) -> Optional[str]:
+        """Stringifies the tool definitions once per update rather than once per render."""
+        if not self._tools_json:
+            return None
+        return f"<tools>{str(self._tools_json)}</tools>"
     def update(self, tools_json: List[Dict]):
         self._tools_json = tools_json
+        self._serialized = self._serialize()
         self.mark_stale()
     async def render(self) -> Optional[str]:
-        if not self._tools_json:
-            return None
-        return f"<tools>{str(self._tools_json)}</tools>"
+        return self._serialized
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        if '_serialized' not in state:
+            # Saved before the serialized form was cached on the instance.
+            self._serialized = self._serialize()
 
     def __eq__(self, other):
         if not isinstance(other, Tools):
@@ -240,41 +416,139 @@ class Tools(ContextProvider):
         return self._tools_json == other._tools_json
 
 class Files(ContextProvider):
-    def __init__(self, *paths: Union[str, List[str]], name: str = "files", visible: bool = True):
-        super().__init__(name, visible=visible)
+    def __init__(self, *paths: Union[str, List[str]], name: str = "files", visible: bool = True, tags: Optional[Iterable[str]] = None, swr: bool = False):
+        super().__init__(name, visible=visible, tags=tags, swr=swr)
         self._files: Dict[str, str] = {}
         self._file_sources: Dict[str, Dict] = {}
 
-        file_paths: List[str] = []
-        if paths:
-            if len(paths) == 1 and isinstance(paths[0], list):
-                file_paths.extend(paths[0])
-            else:
-                file_paths.extend(paths)
+        for path in self._flatten_paths(paths):
+            self.update(path)
 
-        if file_paths:
-            for path in file_paths:
-                self.update(path)
+    @staticmethod
+    def _flatten_paths(paths: tuple) -> List[str]:
+        if len(paths) == 1 and isinstance(paths[0], list):
+            return list(paths[0])
+        return list(paths)
+
+    @classmethod
+    async def aopen(cls, *paths: Union[str, List[str]], name: str = "files", visible: bool = True, tags: Optional[Iterable[str]] = None, swr: bool = False) -> 'Files':
+        """
+        Async counterpart of Files(*paths): the initial reads run concurrently in
+        worker threads instead of one after another on the calling thread.
+        """
+        provider = cls(name=name, visible=visible, tags=tags, swr=swr)
+        file_paths = cls._flatten_paths(paths)
+        contents = await asyncio.gather(*(asyncio.to_thread(provider._read_if_exists, path) for path in file_paths))
+        for path, content in zip(file_paths, contents):
+            if content is None:
+                content = f"[Error: File not found at path '{path}']"
+            provider._files[path] = content
+            provider._file_sources[path] = {'source': 'disk'}
+        provider.mark_stale()
+        return provider
+
+    @staticmethod
+    def _read_whole_file(path: str) -> str:
+        """
+        Reads a whole file as UTF-8 with raw os.read calls, skipping the text and
+        buffered I/O layers. Newlines are normalized like text-mode open() does.
+        """
+        # No memory map here: a file truncated while mapped raises SIGBUS, which
+        # kills the process, and watched files are often rewritten mid-read.
+        # O_BINARY (Windows only) stops the CRT from translating CRLF and treating Ctrl-Z as EOF.
+        fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        try:
+            # A read may return less than asked for (Linux caps one read at 0x7ffff000
+            # bytes, FUSE and network filesystems stop early), so only an empty read
+            # means EOF. The first read asks for the whole file plus one byte.
+            chunks = []
+            want = os.fstat(fd).st_size + 1
+            while chunk := os.read(fd, want):
+                chunks.append(chunk)
+                want = max(want - len(chunk), 1 << 20)
+            data = b"".join(chunks)
+        finally:
+            os.close(fd)
+        text = data.decode('utf-8')
+        if '\r' in text:
+            text = text.replace('\r\n', '\n').replace('\r', '\n')
+        return text
+
+    @staticmethod
+    def _read_head(path: str, head: int) -> str:
+        """
+        Reads the first `head` lines: binary chunks until enough newlines have been
+        seen, then one split and one decode instead of a per-line text-mode loop.
+        """
+        chunks = []
+        newlines = 0
+        with open(path, 'rb') as f:
+            while newlines < head:
+                chunk = f.read(_HEAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                newlines += chunk.count(b'\n')
+                chunks.append(chunk)
+        data = b"".join(chunks)
+        if newlines >= head:
+            # Cutting at a newline never splits a multi-byte character.
+            data = b'\n'.join(data.split(b'\n', head)[:head])
+        text = data.decode('utf-8')
+        if '\r' in text:
+            text = text.replace('\r\n', '\n').replace('\r', '\n')
+            # A lone '\r' also ends a line in text mode.
+            text = '\n'.join(text.split('\n', head)[:head])
+        return text.rstrip('\n')
+
+    def _read_file(self, path: str, head: Optional[int] = None) -> str:
+        """Reads a file on disk, respecting the head parameter; errors propagate."""
+        if head is None or head <= 0:
+            return self._read_whole_file(path)
+        return self._read_head(path, head)
+
+    @staticmethod
+    def _read_error(path: str, e: Exception) -> str:
+        logging.error(f"Error reading file {path}: {e}")
+        return f"[Error: Could not read file at path '{path}': {e}]"
 
     def _read_from_disk(self, path: str, head: Optional[int] = None) -> str:
         """Reads content from a file on disk, respecting the head parameter."""
         try:
-            with open(path, 'r', encoding='utf-8') as f:
-                if head is not None and head > 0:
-                    lines = []
-                    for _ in range(head):
-                        try:
-                            lines.append(next(f))
-                        except StopIteration:
-                            break
-                    return "".join(lines).rstrip('\n')
-                else:
-                    return f.read()
+            return self._read_file(path, head)
         except FileNotFoundError:
             raise
         except Exception as e:
-            logging.error(f"Error reading file {path}: {e}")
-            return f"[Error: Could not read file at path '{path}': {e}]"
+            return self._read_error(path, e)
+
+    def _read_if_exists(self, path: str, head: Optional[int] = None) -> Optional[str]:
+        """Like _read_from_disk, but returns None for a missing file."""
+        try:
+            return self._read_from_disk(path, head)
+        except FileNotFoundError:
+            return None
+
+    def _read_if_changed(self, path: str, head: Optional[int], stamp: Optional[List[int]]):
+        """
+        Stats the file and reads it only if (mtime_ns, size) differs from stamp.
+        Returns (content, new_stamp); content is None if the file is missing or unchanged.
+        Errors come back as error text with no stamp, so the next refresh tries again
+        even when the fix (e.g. chmod) leaves mtime and size alone.
+        """
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None, None
+        except OSError as e:
+            return self._read_error(path, e), None
+        new_stamp = [st.st_mtime_ns, st.st_size]
+        if new_stamp == stamp:
+            return None, new_stamp
+        try:
+            return self._read_file(path, head), new_stamp
+        except FileNotFoundError:
+            return None, None
+        except Exception as e:
+            return self._read_error(path, e), None
 
     async def refresh(self):
         """
@@ -282,39 +556,49 @@ class Files(ContextProvider):
         Content set manually is overwritten if the file exists, but preserved if it does not.
         """
         is_changed = False
-        for path, spec in list(self._file_sources.items()):
+        sources = list(self._file_sources.items())
+        # Check every tracked file concurrently in worker threads so that slow
+        # disks cost roughly the slowest read instead of the sum of all reads.
+        # Files whose stat stamp is unchanged since the last read are not re-read.
+        results = await asyncio.gather(*(
+            asyncio.to_thread(self._read_if_changed, path, spec.get('head'), spec.get('stat'))
+            for path, spec in sources
+        ))
+        for (path, spec), (new_content, stamp) in zip(sources, results):
             if spec.get('source') == 'disk':
-                try:
-                    head = spec.get('head')
-                    new_content = self._read_from_disk(path, head)
-                    if self._files.get(path) != new_content:
-                        self._files[path] = new_content
-                        is_changed = True
-                except FileNotFoundError:
-                    error_msg = f"[Error: File not found at path '{path}']"
-                    if self._files.get(path) != error_msg:
-                        self._files[path] = error_msg
-                        is_changed = True
+                if stamp is not None and stamp == spec.get('stat'):
+                    continue
+                if new_content is None:
+                    new_content = f"[Error: File not found at path '{path}']"
+                if self._files.get(path) != new_content:
+                    self._files[path] = new_content
+                    is_changed = True
+                if stamp is None:
+                    spec.pop('stat', None)
+                else:
+                    spec['stat'] = stamp
             elif spec.get('source') == 'manual':
-                try:
-                    # File exists, so we must overwrite manual content.
-                    head = spec.get('head')
-                    new_content = self._read_from_disk(path, head)
-                    if self._files.get(path) != new_content:
-                        self._files[path] = new_content
-                        is_changed = True
-                    # If we are here, manual content was overwritten by disk content,
-                    # so we should update the source.
-                    self._file_sources[path] = {'source': 'disk'}
-
-                except FileNotFoundError:
+                if new_content is None:
                     # File does not exist, so we keep the manual content. No change.
-                    pass
+                    continue
+                # File exists, so we must overwrite manual content.
+                if self._files.get(path) != new_content:
+                    self._files[path] = new_content
+                    is_changed = True
+                # Manual content was overwritten by disk content,
+                # so we should update the source.
+                self._file_sources[path] = {'source': 'disk'}
+                if stamp is not None:
+                    self._file_sources[path]['stat'] = stamp
 
         if is_changed:
             self.mark_stale()
         await super().refresh()
 
+    def _needs_refresh(self) -> bool:
+        # Any tracked path may have changed on disk since the last refresh.
+        return self._is_stale or bool(self._file_sources)
+
     def update(self, path: str, content: Optional[str] = None, head: Optional[Union[int, str]] = None):
         """
         Updates a single file's content and its source specification.
@@ -356,7 +640,15 @@ class Files(ContextProvider):
         self.mark_stale()
     async def render(self) -> str:
         if not self._files: return None
-        return "<latest_file_content>" + "\n".join([f"<file><file_path>{p}</file_path><file_content>{c}</file_content></file>" for p, c in self._files.items()]) + "\n</latest_file_content>"
+        # One flat list and a single join: no per-file f-string or intermediate list.
+        parts = ["<latest_file_content>"]
+        append = parts.append
+        for p, c in self._files.items():
+            append("<file><file_path>"); append(p)
+            append("</file_path><file_content>"); append(c)
+            append("</file_content></file>\n")
+        append("</latest_file_content>")
+        return "".join(parts)
 
     def __eq__(self, other):
         if not isinstance(other, Files):
@@ -364,27 +656,72 @@ class Files(ContextProvider):
         return self._files == other._files
 
 class Images(ContextProvider):
-    def __init__(self, url: str, name: Optional[str] = None, visible: bool = True):
-        super().__init__(name or url, visible=visible)
+    # (st_mtime_ns, st_size) of the file behind the current _cached_content.
+    _encoded_key: Optional[tuple] = None
+    # Resolved lazily from the path; the class default also covers older pickles.
+    _mime_type: Optional[str] = None
+
+    def __init__(self, url: str, name: Optional[str] = None, visible: bool = True, tags: Optional[Iterable[str]] = None, swr: bool = False):
+        super().__init__(name or url, visible=visible, tags=tags, swr=swr)
         self.url = url
+        self._mime_type: Optional[str] = None
         if self.url.startswith("data:"):
+            # A data URI is already its own rendered form; nothing to refresh.
             self._cached_content = self.url
-        self._is_stale = True
+            self._is_stale = False
+        else:
+            self._is_stale = True
     def update(self, url: str):
         self.url = url
-        self.mark_stale()
+        self._mime_type = None
+        self._encoded_key = None
+        if url.startswith("data:"):
+            self._cached_content = url
+            self._is_stale = False
+            self._notify_owners()
+        else:
+            self.mark_stale()
+    def mark_stale(self):
+        # Data URIs never need re-rendering; visibility is applied at render time.
+        if not self.url.startswith("data:"):
+            super().mark_stale()
+    def _get_mime_type(self) -> str:
+        if self._mime_type is None:
+            mime_type, _ = mimetypes.guess_type(self.url)
+            self._mime_type = mime_type or "application/octet-stream" # Fallback
+        return self._mime_type
+    def _encode_file(self) -> str:
+        """Base64-encodes the image in chunks, so the raw file is never held in memory whole."""
+        encoded = bytearray()
+        with open(self.url, "rb") as image_file:
+            while chunk := image_file.read(_BASE64_CHUNK_SIZE):
+                encoded += _b64encode(chunk)
+        return encoded.decode('ascii')
+    def _load_data_uri(self) -> Tuple[str, tuple]:
+        """
+        Returns (data_uri, key) for the file, re-encoding only if it changed on disk.
+        Runs in a worker thread, so it leaves the cache attributes to the caller.
+        """
+        st = os.stat(self.url)
+        key = (st.st_mtime_ns, st.st_size)
+        if key == self._encoded_key and self._cached_content is not None:
+            return self._cached_content, key
+        return f"data:{self._get_mime_type()};base64,{self._encode_file()}", key
     async def render(self) -> Optional[str]:
         if self.url.startswith("data:"):
             return self.url
         try:
-            with open(self.url, "rb") as image_file:
-                encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
-                mime_type, _ = mimetypes.guess_type(self.url)
-                if not mime_type: mime_type = "application/octet-stream" # Fallback
-                return f"data:{mime_type};base64,{encoded_string}"
+            # Reading and encoding are blocking; keep them off the event loop.
+            data_uri, key = await asyncio.to_thread(self._load_data_uri)
         except FileNotFoundError:
             logging.warning(f"Image file not found: {self.url}. Skipping.")
+            self._encoded_key = None
             return None # Or handle error appropriately
+        # Set together on the loop: a refresh cancelled while the thread ran must not
+        # leave a new key beside the old content.
+        self._encoded_key = key
+        self._cached_content = data_uri
+        return data_uri
 
     def __eq__(self, other):
         if not isinstance(other, Images):
@@ -392,34 +729,34 @@ class Images(ContextProvider):
         return self.url == other.url
 
 # 3. 消息类 (已合并 MessageContent)
-class Message(ABC):
+class Message:
     def __init__(self, role: str, *initial_items: Union[ContextProvider, str, list, 'Message']):
-        self.role = role
+        self.role = sys.intern(role) if type(role) is str else role
         processed_items = []
         for item in initial_items:
             if item is None:
                 continue
 
-            # This is the new recursive flattening logic
-            if isinstance(item, Message):
-                processed_items.extend(item.provider())
-            elif isinstance(item, str):
-                import re
-                placeholder_pattern = re.compile(r'(__provider_placeholder_[a-f0-9]{32}__)')
-                parts = placeholder_pattern.split(item)
-                if len(parts) > 1:
-                    for part in parts:
-                        if not part: continue
-                        if placeholder_pattern.match(part):
-                            provider = _retrieve_provider(part)
-                            if provider:
-                                processed_items.append(provider)
-                        else:
-                            processed_items.append(Texts(text=part))
-                else:
+            # Most common inputs first: strings, then providers, then nested messages.
+            if isinstance(item, str):
+                if _PLACEHOLDER_MARKER not in item:
+                    # Plain string (the common case): no regex work at all.
                     processed_items.append(Texts(text=item))
+                    continue
+                # The pattern has one capturing group, so placeholders sit at odd indices.
+                for i, part in enumerate(_PLACEHOLDER_PATTERN.split(item)):
+                    if not part: continue
+                    if i % 2:
+                        provider = _retrieve_provider(part)
+                        if provider:
+                            processed_items.append(provider)
+                    else:
+                        processed_items.append(Texts(text=part))
             elif isinstance(item, ContextProvider):
                 processed_items.append(item)
+            elif isinstance(item, Message):
+                # This is the new recursive flattening logic
+                processed_items.extend(item.provider())
             elif isinstance(item, list):
                 for sub_item in item:
                     if not isinstance(sub_item, dict) or 'type' not in sub_item:
@@ -445,6 +782,55 @@ class Message(ABC):
                 raise TypeError(f"Unsupported item type: {type(item)}. Must be str, ContextProvider, list, or dict.")
         self._items: List[ContextProvider] = processed_items
         self._parent_messages: Optional['Messages'] = None
+        # Memoized text content, reset whenever a provider or the item list changes.
+        self._rendered: Optional[str] = None
+        self._reindex()
+        self._recount()
+        for item in processed_items:
+            item._owners.add(self)
+
+    @classmethod
+    def _from_items(cls, role: str, items: List[ContextProvider]) -> 'Message':
+        """Builds a message from already-validated providers, skipping the __init__ type dispatch."""
+        obj = cls.__new__(cls)
+        obj.role = role
+        obj._items = items
+        obj._parent_messages = None
+        obj._rendered = None
+        obj._reindex()
+        obj._recount()
+        for item in items:
+            item._owners.add(obj)
+        return obj
+
+    def _with_items(self, items: List[ContextProvider]) -> 'Message':
+        """Returns a new message of the same type holding `items`."""
+        cls = type(self)
+        if cls in _PLAIN_MESSAGE_TYPES:
+            return cls._from_items(self.role, items)
+        # Subclasses with their own __init__ (e.g. ToolResults) need the full constructor.
+        return cls(*items)
+
+    def _invalidate(self):
+        self._rendered = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_rendered'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._rendered = None
+        self._reindex()
+        self._recount()
+        for item in self._items:
+            item._owners.add(self)
+        parent = self._parent_messages
+        if parent is not None and '_providers_index' in parent.__dict__:
+            # The parent was restored first (this message was the object being
+            # copied) and left it out of its index.
+            parent._rebuild_index()
 
     @property
     def content(self) -> Optional[Union[str, List[Dict[str, Any]]]]:
@@ -453,69 +839,149 @@ class Message(ABC):
         For simple text messages, returns a string.
         For multimodal messages, returns a list of content blocks.
         """
+        return self._get_content()
+
+    def _get_content(self) -> Optional[Union[str, List[Dict[str, Any]]]]:
+        """The 'content' field of to_dict(), without building the dict when it can be avoided."""
+        if not self._multimodal_count and type(self).to_dict is Message.to_dict:
+            # Plain text message: serve the memoized string directly.
+            if self._rendered is None:
+                self._rendered = self._render_content()
+            return self._rendered or None
         rendered_dict = self.to_dict()
         return rendered_dict.get('content') if rendered_dict else None
 
     def _render_content(self) -> str:
+        items = self._items
+        if len(items) <= 1:
+            # Nothing to join, and a single item never gets a newline separator.
+            content = items[0]._rendered_text() if items else None
+            return content if content is not None else ""
         final_parts = []
-        for item in self._items:
-            block = item.get_content_block()
-            if block and block.content is not None:
-                # Check if it's a Texts provider with newline=True
-                # and it's not the very first item with content.
-                if isinstance(item, Texts) and hasattr(item, 'newline') and item.newline and final_parts:
-                    final_parts.append("\n\n")
-                final_parts.append(block.content)
+        append = final_parts.append
+        for item in items:
+            content = item._rendered_text()
+            if content is None:
+                continue
+            # Check if it's a Texts provider with newline=True
+            # and it's not the very first item with content. The type check comes
+            # first so other providers never take getattr's missing-attribute path.
+            if final_parts and isinstance(item, Texts) and item.newline:
+                append("\n\n")
+            append(content)
         return "".join(final_parts)
 
-    def pop(self, name: str) -> Optional[ContextProvider]:
-        popped_item = None
+    def _reindex(self):
+        """Rebuilds the name -> positions index after a mid-list mutation."""
+        name_index: Dict[str, List[int]] = {}
         for i, item in enumerate(self._items):
-            if hasattr(item, 'name') and item.name == name:
-                popped_item = self._items.pop(i)
-                break
-        if popped_item and self._parent_messages:
+            name_index.setdefault(item.name, []).append(i)
+        self._name_index = name_index
+
+    def _recount(self):
+        """Rebuilds the per-type provider counts from scratch."""
+        # Exact provider type -> number of items; lets has() answer without scanning _items.
+        self._type_counts: Dict[type, int] = {}
+        # Number of Images items; any image switches to_dict to the list form.
+        self._multimodal_count: int = 0
+        for item in self._items:
+            self._count(item, 1)
+
+    def _count(self, item: ContextProvider, delta: int):
+        item_type = type(item)
+        count = self._type_counts.get(item_type, 0) + delta
+        if count:
+            self._type_counts[item_type] = count
+        else:
+            del self._type_counts[item_type]
+        if isinstance(item, Images):
+            self._multimodal_count += delta
+
+    def pop(self, name: str) -> Optional[ContextProvider]:
+        positions = self._name_index.get(name)
+        if not positions:
+            return None
+        index = positions[0]
+        popped_item = self._items.pop(index)
+        if index == len(self._items):
+            # Popping the tail leaves every other position untouched.
+            del self._name_index[name]
+        else:
+            self._reindex()
+        self._count(popped_item, -1)
+        self._invalidate()
+        if not any(p is popped_item for p in self._items):
+            popped_item._owners.discard(self)
+        if self._parent_messages:
             self._parent_messages._notify_provider_removed(popped_item)
         return popped_item
 
     def insert(self, index: int, item: ContextProvider):
+        appended = index >= len(self._items)
         self._items.insert(index, item)
+        if appended:
+            self._name_index.setdefault(item.name, []).append(len(self._items) - 1)
+        else:
+            self._reindex()
+        self._count(item, 1)
+        item._owners.add(self)
+        self._invalidate()
         if self._parent_messages:
             self._parent_messages._notify_provider_added(item, self)
 
     def append(self, item: ContextProvider):
         self._items.append(item)
+        self._name_index.setdefault(item.name, []).append(len(self._items) - 1)
+        self._count(item, 1)
+        item._owners.add(self)
+        self._invalidate()
         if self._parent_messages:
             self._parent_messages._notify_provider_added(item, self)
 
+    def _extend(self, items: List[ContextProvider]):
+        """Appends several providers at once, invalidating the render cache a single time."""
+        if not items:
+            return
+        items = list(items)
+        start = len(self._items)
+        self._items += items
+        name_index = self._name_index
+        for i, item in enumerate(items, start):
+            name_index.setdefault(item.name, []).append(i)
+            self._count(item, 1)
+            item._owners.add(self)
+        self._invalidate()
+        if self._parent_messages:
+            for item in items:
+                self._parent_messages._notify_provider_added(item, self)
+
     def provider(self, name: Optional[str] = None) -> Optional[Union[ContextProvider, ProviderGroup, List[ContextProvider]]]:
         if name is None:
             return self._items
 
-        named_providers = [p for p in self._items if hasattr(p, 'name') and p.name == name]
-
-        if not named_providers:
+        positions = self._name_index.get(name)
+        if not positions:
             return None
-        if len(named_providers) == 1:
-            return named_providers[0]
-        return ProviderGroup(named_providers)
+        if len(positions) == 1:
+            return self._items[positions[0]]
+        return ProviderGroup([self._items[i] for i in positions])
 
     def __add__(self, other):
         if isinstance(other, str):
             new_items = self._items + [Texts(text=other)]
-            return type(self)(*new_items)
+            return self._with_items(new_items)
         if isinstance(other, Message):
             new_items = self._items + other.provider()
-            return type(self)(*new_items)
+            return self._with_items(new_items)
         return NotImplemented
 
     def __radd__(self, other):
         if isinstance(other, str):
             new_items = [Texts(text=other)] + self._items
-            return type(self)(*new_items)
+            return self._with_items(new_items)
         if isinstance(other, Message):
             new_items = other.provider() + self._items
-            return type(self)(*new_items)
+            return self._with_items(new_items)
         return NotImplemented
 
     def __getitem__(self, key: Union[str, int]) -> Any:
@@ -527,18 +993,15 @@ class Message(ABC):
             if key == 'role':
                 return self.role
             elif key == 'content':
-                # 直接调用 to_dict 并提取 'content'，确保逻辑一致
-                rendered_dict = self.to_dict()
-                return rendered_dict.get('content') if rendered_dict else None
-            # 对于 tool_calls 等特殊属性，也通过 to_dict 获取
+                return self._get_content()
+            # 对于 tool_calls 等特殊属性，优先通过 to_dict 获取，否则回退到对象属性
             elif hasattr(self, key):
                 rendered_dict = self.to_dict()
                 if rendered_dict and key in rendered_dict:
                     return rendered_dict[key]
+                return getattr(self, key)
 
             # 如果在对象本身或其 to_dict() 中都找不到，则引发 KeyError
-            if hasattr(self, key):
-                 return getattr(self, key)
             raise KeyError(f"'{key}'")
         elif isinstance(key, int):
             return self._items[key]
@@ -563,23 +1026,46 @@ class Message(ABC):
         """Checks if the message contains a provider of a specific type."""
         if not isinstance(provider_type, type) or not issubclass(provider_type, ContextProvider):
             raise TypeError("provider_type must be a subclass of ContextProvider")
-        return any(isinstance(p, provider_type) for p in self._items)
+        return any(issubclass(t, provider_type) for t in self._type_counts)
 
     def lstrip(self, provider_type: type):
         """
         从消息的左侧（开头）移除所有指定类型的 provider。
         移除操作会一直持续，直到遇到一个不同类型的 provider 为止。
         """
-        while self._items and type(self._items[0]) is provider_type:
-            self.pop(self._items[0].name)
+        items = self._items
+        stop = 0
+        while stop < len(items) and type(items[stop]) is provider_type:
+            stop += 1
+        self._remove_range(0, stop)
 
     def rstrip(self, provider_type: type):
         """
         从消息的右侧（末尾）移除所有指定类型的 provider。
         移除操作会一直持续，直到遇到一个不同类型的 provider 为止。
         """
-        while self._items and type(self._items[-1]) is provider_type:
-            self.pop(self._items[-1].name)
+        items = self._items
+        start = len(items)
+        while start and type(items[start - 1]) is provider_type:
+            start -= 1
+        self._remove_range(start, len(items))
+
+    def _remove_range(self, start: int, stop: int):
+        """按位置移除 self._items[start:stop]，只重建一次索引。"""
+        removed = self._items[start:stop]
+        if not removed:
+            return
+        del self._items[start:stop]
+        self._reindex()
+        for item in removed:
+            self._count(item, -1)
+        self._invalidate()
+        remaining = {id(p) for p in self._items}
+        for item in removed:
+            if id(item) not in remaining:
+                item._owners.discard(self)
+            if self._parent_messages:
+                self._parent_messages._notify_provider_removed(item)
 
     def strip(self, provider_type: type):
         """
@@ -595,9 +1081,10 @@ class Message(ABC):
         return getattr(self, key, default)
 
     async def refresh(self):
-        """刷新此消息中的所有 provider。"""
-        tasks = [provider.refresh() for provider in self._items]
-        await asyncio.gather(*tasks)
+        """刷新此消息中需要刷新的 provider。"""
+        tasks = [provider.refresh() for provider in self._items if provider._needs_refresh()]
+        if tasks:
+            await asyncio.gather(*tasks)
 
     async def render(self) -> Optional[Dict[str, Any]]:
         """
@@ -605,7 +1092,7 @@ class Message(ABC):
         后续调用将返回缓存版本，除非手动调用了 refresh()。
         """
         # 检查是否是首次渲染
-        is_first_render = not all(hasattr(p, '_cached_content') and p._cached_content is not None for p in self._items if p._is_stale)
+        is_first_render = any(p._is_stale and p._cached_content is None for p in self._items)
 
         if is_first_render:
             await self.refresh()
@@ -618,21 +1105,20 @@ class Message(ABC):
         return self.to_dict()
 
     def to_dict(self) -> Optional[Dict[str, Any]]:
-        is_multimodal = any(isinstance(p, Images) for p in self._items)
-
-        if not is_multimodal:
-            rendered_content = self._render_content()
-            if not rendered_content: return None
-            return {"role": self.role, "content": rendered_content}
+        if not self._multimodal_count:
+            if self._rendered is None:
+                self._rendered = self._render_content()
+            if not self._rendered: return None
+            return {"role": self.role, "content": self._rendered}
         else:
             content_list = []
             for item in self._items:
-                block = item.get_content_block()
-                if not block or not block.content: continue
+                content = item._rendered_text()
+                if not content: continue
                 if isinstance(item, Images):
-                    content_list.append({"type": "image_url", "image_url": {"url": block.content}})
+                    content_list.append({"type": "image_url", "image_url": {"url": content}})
                 else:
-                    content_list.append({"type": "text", "text": block.content})
+                    content_list.append({"type": "text", "text": content})
             if not content_list: return None
             return {"role": self.role, "content": content_list}
 
@@ -643,17 +1129,22 @@ class UserMessage(Message):
 class AssistantMessage(Message):
     def __init__(self, *items): super().__init__("assistant", *items)
 
+# Message types whose constructor only dispatches items; `+` can build them via _from_items.
+_PLAIN_MESSAGE_TYPES = frozenset({Message, SystemMessage, UserMessage, AssistantMessage})
+
+_ROLE_TABLE: Dict[str, type] = {
+    'system': SystemMessage,
+    'user': UserMessage,
+    'assistant': AssistantMessage,
+}
+
 class RoleMessage:
     """A factory class that creates a specific message type based on the role."""
     def __new__(cls, role: str, *items):
-        if role == 'system':
-            return SystemMessage(*items)
-        elif role == 'user':
-            return UserMessage(*items)
-        elif role == 'assistant':
-            return AssistantMessage(*items)
-        else:
+        message_cls = _ROLE_TABLE.get(role)
+        if message_cls is None:
             raise ValueError(f"Invalid role: {role}. Must be 'system', 'user', or 'assistant'.")
+        return message_cls(*items)
 
 class ToolCalls(Message):
     """Represents an assistant message that requests tool calls."""
@@ -712,42 +1203,81 @@ class ToolResults(Message):
 # 4. 顶层容器: Messages
 class Messages:
     def __init__(self, *initial_messages: Message):
-        from typing import Tuple
         self._messages: List[Message] = []
-        self._providers_index: Dict[str, List[Tuple[ContextProvider, Message]]] = {}
+        # For each name, providers keyed by identity (insertion-ordered), and in a
+        # parallel dict the messages holding each of them. Removal is O(1).
+        self._providers_index: Dict[str, Dict[int, ContextProvider]] = {}
+        self._provider_parents: Dict[str, Dict[int, List[Message]]] = {}
+        self._tag_index: Dict[str, Dict[int, ContextProvider]] = {}
         if initial_messages:
             for msg in initial_messages:
                 self.append(msg)
 
     def _notify_provider_added(self, provider: ContextProvider, message: Message):
-        if provider.name not in self._providers_index:
-            self._providers_index[provider.name] = []
-        self._providers_index[provider.name].append((provider, message))
+        name = provider.name
+        key = id(provider)
+        bucket = self._providers_index.get(name)
+        if bucket is None:
+            bucket = self._providers_index[name] = {}
+            parents = self._provider_parents[name] = {}
+        else:
+            parents = self._provider_parents[name]
+        if key in bucket:
+            # The same provider placed in another message.
+            parents[key].append(message)
+        else:
+            bucket[key] = provider
+            parents[key] = [message]
+        for tag in provider.tags:
+            self._tag_index.setdefault(tag, {})[key] = provider
 
     def _notify_provider_removed(self, provider: ContextProvider):
-        if provider.name in self._providers_index:
-            # Create a new list excluding the provider to be removed.
-            # Comparing by object identity (`is`) is crucial here.
-            providers_list = self._providers_index[provider.name]
-            new_list = [(p, m) for p, m in providers_list if p is not provider]
-
-            if not new_list:
-                # If the list becomes empty, remove the key from the dictionary.
-                del self._providers_index[provider.name]
-            else:
-                # Otherwise, update the dictionary with the new list.
-                self._providers_index[provider.name] = new_list
+        name = provider.name
+        key = id(provider)
+        bucket = self._providers_index.get(name)
+        if bucket is not None and bucket.pop(key, None) is not None:
+            parents = self._provider_parents[name]
+            del parents[key]
+            if not bucket:
+                # If the bucket becomes empty, remove the key from both dictionaries.
+                del self._providers_index[name]
+                del self._provider_parents[name]
+        for tag in provider.tags:
+            tagged = self._tag_index.get(tag)
+            if tagged is not None:
+                tagged.pop(key, None)
+                if not tagged:
+                    del self._tag_index[tag]
 
     def provider(self, name: str) -> Optional[Union[ContextProvider, ProviderGroup]]:
-        indexed_list = self._providers_index.get(name)
-        if not indexed_list:
+        bucket = self._providers_index.get(name)
+        if not bucket:
             return None
 
-        providers = [p for p, m in indexed_list]
-        if len(providers) == 1:
-            return providers[0]
-        else:
-            return ProviderGroup(providers)
+        parents = self._provider_parents[name]
+        if len(bucket) == 1:
+            key, provider = next(iter(bucket.items()))
+            if len(parents[key]) == 1:
+                return provider
+        # A provider placed in several messages appears once per placement.
+        return ProviderGroup([p for key, p in bucket.items() for _ in parents[key]])
+
+    async def await_pending_refreshes(self):
+        """Waits for background stale-while-revalidate refreshes to finish."""
+        tasks = []
+        for bucket in self._providers_index.values():
+            for provider in bucket.values():
+                task = provider._refresh_task
+                if task is not None and not task.done():
+                    tasks.append(task)
+        if tasks:
+            await asyncio.gather(*tasks)
+
+    def invalidate_tags(self, *tags: str):
+        """Marks every provider carrying any of the given tags as stale."""
+        for tag in tags:
+            for provider in list(self._tag_index.get(tag, {}).values()):
+                provider.mark_stale()
 
     def pop(self, key: Optional[Union[str, int]] = None) -> Union[Optional[ContextProvider], Optional[Message]]:
         # If no key is provided, pop the last message.
@@ -755,11 +1285,11 @@ class Messages:
             key = len(self._messages) - 1
 
         if isinstance(key, str):
-            indexed_list = self._providers_index.get(key)
-            if not indexed_list:
+            parents = self._provider_parents.get(key)
+            if not parents:
                 return None
             # Pop the first one found, which is consistent with how pop usually works
-            _provider, parent_message = indexed_list[0]
+            parent_message = next(iter(parents.values()))[0]
             # The actual removal from _providers_index happens in _notify_provider_removed
             # which is called by message.pop()
             return parent_message.pop(key)
@@ -779,74 +1309,204 @@ class Messages:
 
         return None
 
-    async def refresh(self):
-        tasks = []
-        for provider_list in self._providers_index.values():
-            for provider, _ in provider_list:
-                tasks.append(provider.refresh())
-        await asyncio.gather(*tasks)
+    async def refresh(self, max_concurrency: Optional[int] = None):
+        """
+        Refreshes every provider that has work to do, concurrently.
+        max_concurrency caps how many provider refreshes run at once, which keeps
+        large batches of Files/Images from flooding the worker thread pool.
+        """
+        if max_concurrency is not None and max_concurrency < 1:
+            raise ValueError(f"max_concurrency must be a positive integer or None, got {max_concurrency}.")
+        # Only schedule providers that actually have work to do; cache-hot
+        # providers would just return immediately from refresh(). A provider
+        # shared by several messages is refreshed once.
+        pending = {}
+        for bucket in self._providers_index.values():
+            for provider in bucket.values():
+                if provider._needs_refresh():
+                    pending[id(provider)] = provider
+        if not pending:
+            return
+        if max_concurrency is None or len(pending) <= max_concurrency:
+            await asyncio.gather(*(p.refresh() for p in pending.values()))
+            return
+
+        semaphore = asyncio.Semaphore(max_concurrency)
+        async def run(provider: ContextProvider):
+            async with semaphore:
+                await provider.refresh()
+        await asyncio.gather(*(run(p) for p in pending.values()))
 
     def render(self) -> List[Dict[str, Any]]:
-        results = [msg.to_dict() for msg in self._messages]
-        non_empty_results = [res for res in results if res]
-
-        if not non_empty_results:
-            return []
-
-        merged_results = [non_empty_results[0]]
-        for i in range(1, len(non_empty_results)):
-            current_msg = non_empty_results[i]
-            last_merged_msg = merged_results[-1]
+        # Single pass: drop empty messages and merge neighbours as we go.
+        merged_results = []
+        append = merged_results.append
+        last_merged_msg = None
+        # String contents of the current mergeable run, joined once when the run ends
+        # (None when last_merged_msg cannot absorb further messages).
+        run = None
+        for msg in self._messages:
+            current_msg = msg.to_dict()
+            if not current_msg:
+                continue
 
+            content = current_msg.get('content')
+            mergeable = 'tool_calls' not in current_msg and isinstance(content, str)
             # Merge if roles match, no tool_calls, and content is string
-            if (current_msg.get('role') == last_merged_msg.get('role') and
-                'tool_calls' not in current_msg and
-                'tool_calls' not in last_merged_msg and
-                isinstance(current_msg.get('content'), str) and
-                isinstance(last_merged_msg.get('content'), str)):
-                last_merged_msg['content'] += current_msg.get('content', '')
-            else:
-                merged_results.append(current_msg)
-
+            if (run is not None and mergeable and
+                current_msg.get('role') == last_merged_msg.get('role')):
+                run.append(content)
+                continue
+            if run is not None and len(run) > 1:
+                last_merged_msg['content'] = "".join(run)
+            append(current_msg)
+            last_merged_msg = current_msg
+            run = [content] if mergeable else None
+
+        if run is not None and len(run) > 1:
+            last_merged_msg['content'] = "".join(run)
         return merged_results
 
-    async def render_latest(self) -> List[Dict[str, Any]]:
-        await self.refresh()
+    async def render_latest(self, max_concurrency: Optional[int] = None) -> List[Dict[str, Any]]:
+        await self.refresh(max_concurrency)
         return self.render()
 
     def append(self, message: Message):
         if self._messages and self._messages[-1].role == message.role:
-            last_message = self._messages[-1]
-            for provider in message.provider():
-                last_message.append(provider)
+            # Merge into the previous message in one batch.
+            self._messages[-1]._extend(message.provider())
         else:
             message._parent_messages = self
             self._messages.append(message)
             for p in message.provider():
                 self._notify_provider_added(p, message)
 
+    # Indexes keyed by object identity; they are rebuilt rather than pickled.
+    _INDEX_ATTRS = ('_providers_index', '_provider_parents', '_tag_index')
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for attr in self._INDEX_ATTRS:
+            state.pop(attr, None)
+        return state
+
+    def __setstate__(self, state):
+        # Older files may still carry a (differently shaped) index; always rebuild.
+        self.__dict__.update({k: v for k, v in state.items() if k not in self._INDEX_ATTRS})
+        self._rebuild_index()
+
+    def _rebuild_index(self):
+        self._providers_index = {}
+        self._provider_parents = {}
+        self._tag_index = {}
+        for message in self._messages:
+            if '_items' not in message.__dict__:
+                # A message unpickled through its back-reference to us is not built yet;
+                # its own __setstate__ calls back here once it is.
+                continue
+            for p in message.provider():
+                self._notify_provider_added(p, message)
+
+    # Message-level attributes that are derived or rebuilt on load.
+    _DERIVED_MESSAGE_ATTRS = ('_parent_messages', '_rendered', '_name_index', '_type_counts', '_multimodal_count')
+
+    def _to_jsonable(self) -> Optional[Dict[str, Any]]:
+        """
+        Flattens the messages into plain JSON data: a table of providers (so a provider
+        shared by several messages is stored once) and messages referring to it by index.
+        Returns None if anything cannot be represented exactly, e.g. custom subclasses
+        or tool calls that are SDK objects rather than dicts.
+        """
+        providers: List[Dict[str, Any]] = []
+        provider_ids: Dict[int, int] = {}
+        messages = []
+        for message in self._messages:
+            if _JSON_TYPES.get(type(message).__name__) is not type(message):
+                return None
+            items = []
+            for provider in message._items:
+                index = provider_ids.get(id(provider))
+                if index is None:
+                    if _JSON_TYPES.get(type(provider).__name__) is not type(provider):
+                        return None
+                    state = provider.__getstate__()
+                    # Cache keys only speed up the next render and are rebuilt on demand.
+                    state.pop('_encoded_key', None)
+                    state['tags'] = list(state.get('tags', ()))
+                    if not _is_plain_json(state):
+                        return None
+                    index = provider_ids[id(provider)] = len(providers)
+                    providers.append({"type": type(provider).__name__, "state": state})
+                items.append(index)
+            state = {k: v for k, v in message.__getstate__().items() if k not in self._DERIVED_MESSAGE_ATTRS}
+            state['_items'] = items
+            if not _is_plain_json(state):
+                return None
+            messages.append({"type": type(message).__name__, "state": state})
+        return {"architext": 1, "providers": providers, "messages": messages}
+
+    @classmethod
+    def _from_jsonable(cls, data: Dict[str, Any]) -> 'Messages':
+        providers = []
+        for entry in data["providers"]:
+            provider = _JSON_TYPES[entry["type"]].__new__(_JSON_TYPES[entry["type"]])
+            state = entry["state"]
+            state['tags'] = frozenset(state.get('tags', ()))
+            provider.__setstate__(state)
+            providers.append(provider)
+
+        messages = cls()
+        for entry in data["messages"]:
+            message = _JSON_TYPES[entry["type"]].__new__(_JSON_TYPES[entry["type"]])
+            state = entry["state"]
+            state['_items'] = [providers[i] for i in state['_items']]
+            state['_parent_messages'] = None
+            message.__setstate__(state)
+            message._parent_messages = messages
+            # Restored as saved: consecutive same-role messages are not merged again.
+            messages._messages.append(message)
+            for provider in message._items:
+                messages._notify_provider_added(provider, message)
+        return messages
+
     def save(self, file_path: str):
         """
-        Saves the entire Messages object to a file using pickle.
-        Warning: Deserializing data with pickle from an untrusted source is insecure.
+        Saves the entire Messages object to a file as JSON.
+        Messages holding objects JSON cannot represent exactly (custom provider or message
+        subclasses, SDK tool_call objects) are saved with pickle instead.
         """
+        data = self._to_jsonable()
+        # Serialize fully before opening the file so a failure leaves any previous save intact.
+        payload = None
+        if data is not None:
+            try:
+                payload = _json_dumps(data)
+            except (TypeError, ValueError, UnicodeEncodeError):
+                # Plain values the encoder still rejects, e.g. integers beyond 64 bits
+                # under orjson or strings with lone surrogates.
+                payload = None
+        if payload is None:
+            payload = pickle.dumps(self)
         with open(file_path, 'wb') as f:
-            pickle.dump(self, f)
+            f.write(payload)
 
     @classmethod
     def load(cls, file_path: str) -> Optional['Messages']:
         """
-        Loads a Messages object from a file using pickle.
-        Returns the loaded object, or None if the file is not found or an error occurs.
-        Warning: Only load files from a trusted source.
+        Loads a Messages object saved by save(), in either the JSON or the pickle format.
+        Returns an empty Messages if the file is not found or cannot be deserialized.
+        Warning: Pickle files can execute code when loaded; only load files from a trusted source.
         """
         try:
             with open(file_path, 'rb') as f:
-                return pickle.load(f)
+                raw = f.read()
+            if raw.lstrip()[:1] == b'{':
+                return cls._from_jsonable(_json_loads(raw))
+            return pickle.loads(raw)
         except FileNotFoundError:
             # logging.warning(f"File not found at {file_path}, returning empty Messages.")
             return cls()
-        except (pickle.UnpicklingError, EOFError) as e:
+        except (pickle.UnpicklingError, EOFError, ValueError, KeyError, IndexError, TypeError) as e:
             logging.error(f"Could not deserialize file {file_path}: {e}")
             return cls()
 
@@ -911,3 +1571,11 @@ class Messages:
             # Check if any message contains the provider
             return any(item in msg for msg in self._messages)
         return False
+
+# Classes whose state Messages.save() can write as JSON; anything else falls back to pickle.
+_JSON_TYPES: Dict[str, type] = {
+    cls.__name__: cls for cls in (
+        Texts, Tools, Files, Images,
+        Message, SystemMessage, UserMessage, AssistantMessage, ToolCalls, ToolResults,
+    )
+}
@@ -1932,6 +1932,550 @@ Files: {Files(visible=True, name="files")}
         self.assertEqual(counter, 3, "Dynamic function should be re-evaluated on each render_latest call")
 
 
+    async def test_zze_message_render_cache_invalidation(self):
+        """测试 Message 的渲染缓存在 provider 变化后是否正确失效"""
+        import copy
+        text_provider = Texts("first", name="cached")
+        message = UserMessage(text_provider, Texts("second"))
+        await message.refresh()
+        self.assertEqual(message.content, "firstsecond")
+
+        # 可见性变化无需刷新即可生效
+        text_provider.visible = False
+        self.assertEqual(message.content, "second")
+        text_provider.visible = True
+
+        # 更新内容后，refresh 使缓存失效
+        text_provider.update("updated")
+        self.assertEqual(message.content, "firstsecond")
+        await message.refresh()
+        self.assertEqual(message.content, "updatedsecond")
+
+        # 深拷贝后的 provider 只通知拷贝出的消息
+        copied = copy.deepcopy(message)
+        copied.provider("cached").update("copied")
+        await copied.refresh()
+        self.assertEqual(copied.content, "copiedsecond")
+        self.assertEqual(message.content, "updatedsecond")
+
+    async def test_zzf_invalidate_providers_by_tag(self):
+        """测试通过标签批量将 provider 标记为过期"""
+        counter = {"n": 0}
+
+        class Counter(Texts):
+            async def render(self) -> Optional[str]:
+                counter["n"] += 1
+                return str(counter["n"])
+
+        tagged_a = Counter("a", name="a", tags={"project"})
+        tagged_b = Counter("b", name="b", tags=["project", "other"])
+        untagged = Counter("c", name="c")
+        messages = Messages(UserMessage(tagged_a, tagged_b), AssistantMessage(untagged))
+        await messages.refresh()
+        self.assertEqual(counter["n"], 3)
+
+        messages.invalidate_tags("project")
+        self.assertTrue(tagged_a._is_stale and tagged_b._is_stale)
+        self.assertFalse(untagged._is_stale)
+        await messages.refresh()
+        self.assertEqual(counter["n"], 5)
+
+        # 弹出后不再受标签失效影响
+        messages.pop("b")
+        messages.invalidate_tags("other")
+        self.assertFalse(tagged_b._is_stale)
+
+    async def test_zzg_stale_while_revalidate(self):
+        """测试 swr 模式下 refresh 立即返回缓存内容并在后台更新"""
+        release = asyncio.Event()
+
+        class Slow(Texts):
+            async def render(self) -> Optional[str]:
+                await release.wait()
+                return await super().render()
+
+        provider = Slow("old", name="slow", swr=True)
+        messages = Messages(UserMessage(provider))
+        # Texts 在构造时已缓存内容，因此首次刷新也会立即返回
+        await messages.refresh()
+        self.assertEqual(messages.render()[0]['content'], "old")
+        release.set()
+        await messages.await_pending_refreshes()
+        release.clear()
+
+        provider.update("new")
+        await messages.refresh()
+        self.assertEqual(messages.render()[0]['content'], "old")
+
+        release.set()
+        await messages.await_pending_refreshes()
+        self.assertEqual(messages.render()[0]['content'], "new")
+        self.assertFalse(provider._is_stale)
+
+    async def test_zzh_merge_append_invalidates_cache(self):
+        """测试追加同角色消息合并后，渲染缓存和 provider 索引是否同步更新"""
+        messages = Messages(UserMessage("hi"))
+        rendered = await messages.render_latest()
+        self.assertEqual(rendered[0]['content'], "hi")
+
+        messages.append(UserMessage(Texts("there", name="extra"), Texts("!", name="extra")))
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(len(messages[0]), 3)
+        self.assertEqual(len(messages.provider("extra")), 2)
+        self.assertEqual(len(messages[0].provider("extra")), 2)
+
+        rendered = await messages.render_latest()
+        self.assertEqual(rendered[0]['content'], "hithere!")
+
+        popped = messages.pop("extra")
+        self.assertEqual(popped.name, "extra")
+        self.assertIs(messages.provider("extra"), messages[0][1])
+        rendered = await messages.render_latest()
+        self.assertEqual(rendered[0]['content'], "hi!")
+
+    async def test_zzi_has_tracks_mutations(self):
+        """测试 Message.has 在 append/insert/pop 之后是否仍然准确"""
+        message = UserMessage("hi")
+        self.assertFalse(message.has(Images))
+
+        message.append(Images("data:image/png;base64,AAAA", name="img"))
+        message.insert(0, Tools([{"name": "t"}], name="tools"))
+        self.assertTrue(message.has(Images))
+        self.assertTrue(message.has(Tools))
+        self.assertTrue(message.has(ContextProvider))
+
+        message.pop("img")
+        self.assertFalse(message.has(Images))
+        message.pop("tools")
+        self.assertFalse(message.has(Tools))
+        self.assertTrue(message.has(Texts))
+
+    async def test_zzj_images_reuse_encoding_for_unchanged_file(self):
+        """测试图片文件未变化时，重复刷新不会重新编码"""
+        from unittest.mock import patch
+        image_path = "test_image_cache.png"
+        with open(image_path, "wb") as f:
+            f.write(b"first")
+        try:
+            image = Images(image_path)
+            with patch.object(image, "_encode_file", wraps=image._encode_file) as encode:
+                await image.refresh()
+                first = image._cached_content
+                image.mark_stale()
+                await image.refresh()
+                self.assertEqual(encode.call_count, 1)
+                self.assertIs(image._cached_content, first)
+
+                # 文件内容（大小）变化后重新编码
+                with open(image_path, "wb") as f:
+                    f.write(b"second!")
+                image.mark_stale()
+                await image.refresh()
+                self.assertEqual(encode.call_count, 2)
+                self.assertTrue(image._cached_content.endswith("c2Vjb25kIQ=="))
+        finally:
+            os.remove(image_path)
+
+    async def test_zzk_refresh_with_max_concurrency(self):
+        """测试 Messages.refresh 的并发上限"""
+        import asyncio
+        running = 0
+        peak = 0
+
+        class SlowTexts(Texts):
+            async def render(self):
+                nonlocal running, peak
+                running += 1
+                peak = max(peak, running)
+                await asyncio.sleep(0.01)
+                running -= 1
+                return await super().render()
+
+        shared = SlowTexts("shared", name="shared")
+        messages = Messages(
+            UserMessage(*[SlowTexts(f"t{i}", name=f"t{i}") for i in range(6)], shared),
+            AssistantMessage("ok"),
+            UserMessage(shared),
+        )
+        rendered = await messages.render_latest(max_concurrency=2)
+        self.assertLessEqual(peak, 2)
+        self.assertEqual(rendered[0]['content'], "t0t1t2t3t4t5shared")
+        self.assertEqual(rendered[2]['content'], "shared")
+
+        # 非正数的上限会直接报错，而不是永远挂起
+        for bad in (0, -1):
+            with self.assertRaises(ValueError):
+                await messages.refresh(max_concurrency=bad)
+
+    async def test_zzl_save_load_json_format(self):
+        """测试 Messages.save 默认写出 JSON，并保留共享 provider 与旧版 pickle 兼容"""
+        import pickle
+        test_file_path = "test_save_json.json"
+        shared = Texts("shared", name="shared", tags=["t"])
+        messages = Messages(
+            SystemMessage("sys", shared, Tools([{"name": "tool"}])),
+            UserMessage("hi", shared),
+            ToolCalls([{"id": "call_1", "type": "function", "function": {"name": "f", "arguments": "{}"}}]),
+            ToolResults("call_1", "done"),
+        )
+        original = await messages.render_latest()
+        try:
+            messages.save(test_file_path)
+            with open(test_file_path, "rb") as f:
+                self.assertEqual(f.read(1), b"{")
+
+            loaded = Messages.load(test_file_path)
+            self.assertEqual(await loaded.render_latest(), original)
+            group = loaded.provider("shared")
+            self.assertIs(group[0], group[1])
+            self.assertIsInstance(loaded[2], ToolCalls)
+
+            # pickle 格式的文件仍可加载
+            with open(test_file_path, "wb") as f:
+                pickle.dump(messages, f)
+            self.assertEqual(await Messages.load(test_file_path).render_latest(), original)
+        finally:
+            if os.path.exists(test_file_path):
+                os.remove(test_file_path)
+
+    async def test_zzn_files_large_file_read(self):
+        """测试大文件读取结果与文本模式一致"""
+        test_file = "test_large_file.txt"
+        line = "第一行 line\r\n"
+        with open(test_file, "w", encoding="utf-8", newline="") as f:
+            f.write(line * (1024 * 1024 // len(line.encode("utf-8")) + 1))
+        try:
+            with open(test_file, "r", encoding="utf-8") as f:
+                expected = f.read()
+            files = Files(test_file)
+            self.assertEqual(files._files[test_file], expected)
+        finally:
+            os.remove(test_file)
+
+    async def test_zzo_data_uri_images_skip_refresh(self):
+        """测试 data URI 图片无需刷新，且可见性与 update 仍然生效"""
+        url = "data:image/png;base64,AAAA"
+        image = Images(url, name="inline")
+        image.render = AsyncMock(wraps=image.render)
+        messages = Messages(UserMessage("hi", image))
+
+        rendered = await messages.render_latest()
+        self.assertEqual(rendered[0]['content'][1]['image_url']['url'], url)
+        image.visible = False
+        image.mark_stale()
+        rendered = await messages.render_latest()
+        self.assertEqual(len(rendered[0]['content']), 1)
+        self.assertEqual(image.render.call_count, 0)
+
+        image.visible = True
+        image.update("data:image/gif;base64,BBBB")
+        rendered = messages.render()
+        self.assertEqual(rendered[0]['content'][1]['image_url']['url'], "data:image/gif;base64,BBBB")
+
+    async def test_zzp_files_aopen(self):
+        """测试 Files.aopen 并发读取与同步构造结果一致"""
+        paths = ["test_aopen_1.txt", "test_aopen_2.txt"]
+        for i, path in enumerate(paths):
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(f"content {i}")
+        try:
+            async_files = await Files.aopen(paths + ["missing_aopen.txt"], name="code")
+            sync_files = Files(paths + ["missing_aopen.txt"], name="code")
+            self.assertEqual(async_files, sync_files)
+            self.assertEqual(async_files.name, "code")
+            self.assertEqual(await async_files.render(), await sync_files.render())
+        finally:
+            for path in paths:
+                os.remove(path)
+
+    async def test_zzq_files_refresh_skips_unchanged(self):
+        """测试 Files.refresh 对未变化（mtime 与大小相同）的文件不会重复读取"""
+        from unittest.mock import patch
+        test_file = "test_refresh_stat.txt"
+        with open(test_file, "w", encoding="utf-8") as f:
+            f.write("v1")
+        try:
+            files = Files(test_file)
+            await files.refresh()
+            with patch.object(files, "_read_file", wraps=files._read_file) as read:
+                await files.refresh()
+                await files.refresh()
+                self.assertEqual(read.call_count, 0)
+
+                with open(test_file, "w", encoding="utf-8") as f:
+                    f.write("version 2")
+                await files.refresh()
+                self.assertEqual(read.call_count, 1)
+            self.assertIn("version 2", files._cached_content)
+        finally:
+            os.remove(test_file)
+
+    async def test_zzr_texts_get_shares_instances(self):
+        """测试 Texts.get 对相同文本返回共享实例，且不影响普通构造"""
+        import gc
+        first = Texts.get("shared prompt")
+        self.assertIs(Texts.get("shared prompt"), first)
+        self.assertIsNot(Texts("shared prompt"), first)
+        self.assertEqual(first.name, Texts("shared prompt").name)
+
+        messages = Messages(UserMessage(first), AssistantMessage("ok"), UserMessage(Texts.get("shared prompt")))
+        rendered = await messages.render_latest()
+        self.assertEqual(rendered[0]['content'], "shared prompt")
+        self.assertEqual(rendered[2]['content'], "shared prompt")
+
+        del first, messages
+        gc.collect()
+        from architext.core import _texts_cache
+        self.assertNotIn((Texts, "shared prompt"), _texts_cache)
+
+    async def test_zzs_provider_index_identity_buckets(self):
+        """测试同名 provider 的索引在移除后保持顺序，且共享 provider 按放置次数出现"""
+        items = [Texts(f"item {i}", name="item") for i in range(4)]
+        messages = Messages(UserMessage(*items))
+        messages[0].pop("item")
+        group = messages.provider("item")
+        self.assertEqual([p.content for p in group], ["item 1", "item 2", "item 3"])
+
+        shared = Texts("shared", name="shared")
+        messages.append(AssistantMessage(shared))
+        messages.append(UserMessage(shared))
+        self.assertEqual(len(messages.provider("shared")), 2)
+        self.assertIs(messages.pop("shared"), shared)
+
+    async def test_zzt_message_add_reuses_providers(self):
+        """测试消息拼接直接复用已有 provider，并保持索引与渲染正确"""
+        a, b = Texts("a", name="a"), Texts("b", name="b")
+        combined = UserMessage(a) + UserMessage(b)
+        self.assertIsInstance(combined, UserMessage)
+        self.assertIs(combined.provider("b"), b)
+        self.assertEqual(combined.content, "ab")
+
+        combined = "x" + AssistantMessage(a)
+        self.assertEqual(combined.role, "assistant")
+        self.assertEqual(combined.content, "xa")
+
+        a.update("A")
+        self.assertEqual((await Messages(b + UserMessage(a)).render_latest())[0]['content'], "bA")
+
+    async def test_zzu_tool_results_plain_string_keeps_provider(self):
+        """测试纯字符串的 ToolResults 保留一个 Texts provider，真值与长度不变"""
+        tool_results = ToolResults(tool_call_id="call_1", content="plain result")
+        self.assertEqual(len(tool_results), 1)
+        self.assertTrue(tool_results)
+        self.assertIsInstance(tool_results[0], Texts)
+        self.assertEqual(tool_results['content'], "plain result")
+
+        messages = Messages(UserMessage("hi"), tool_results)
+        rendered = await messages.render_latest()
+        self.assertEqual(rendered[1], {"role": "tool", "tool_call_id": "call_1", "content": "plain result"})
+
+    async def test_zzv_rstrip_removes_trailing_duplicate_names(self):
+        """测试 rstrip 按位置移除末尾 provider，即使前面有同名 provider"""
+        head, tail = Texts("\n", name="sep"), Texts("\n", name="sep")
+        message = UserMessage(head, Texts("body"), tail)
+        messages = Messages(message)
+        message.rstrip(Texts)
+        self.assertEqual(message.provider(), [])
+
+        message = UserMessage(head, Images(url="data:image/png;base64,AAA"), tail)
+        messages = Messages(message)
+        message.rstrip(Texts)
+        self.assertEqual(len(message), 2)
+        self.assertIs(message[0], head)
+        self.assertIs(messages.provider("sep"), head)
+        message.lstrip(Texts)
+        self.assertEqual(len(message), 1)
+        self.assertIsNone(messages.provider("sep"))
+
+    async def test_zzw_files_head_mixed_newlines(self):
+        """测试 head 读取对 \\r\\n 与 \\r 换行和多字节字符的处理与文本模式一致"""
+        test_file = "test_head_newlines.txt"
+        with open(test_file, "w", encoding="utf-8", newline="") as f:
+            f.write("第一行\r\n第二行\r第三行\n第四行\n")
+        try:
+            files = Files()
+            files.update(path=test_file, head=2)
+            self.assertEqual(files._files[test_file], "第一行\n第二行")
+            files.update(path=test_file, head=10)
+            self.assertEqual(files._files[test_file], "第一行\n第二行\n第三行\n第四行")
+        finally:
+            os.remove(test_file)
+
+    async def test_zzx_render_merges_runs_of_same_role(self):
+        """测试空消息被跳过后，连续同角色消息的内容被一次性合并"""
+        hidden_a, hidden_b = Texts("x", name="hidden_a"), Texts("y", name="hidden_b")
+        messages = Messages(
+            UserMessage("a"), AssistantMessage(hidden_a),
+            UserMessage("b"), AssistantMessage(hidden_b),
+            UserMessage("c"), AssistantMessage("done"),
+        )
+        hidden_a.visible = False
+        hidden_b.visible = False
+        rendered = await messages.render_latest()
+        self.assertEqual(rendered, [
+            {"role": "user", "content": "abc"},
+            {"role": "assistant", "content": "done"},
+        ])
+
+    async def test_zzy_load_legacy_pickle(self):
+        """测试加载本系列改动之前的版本保存的 pickle 文件"""
+        legacy_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "legacy_messages.pkl")
+        loaded = Messages.load(legacy_path)
+        self.assertEqual(len(loaded), 4)
+        rendered = await loaded.render_latest()
+        self.assertEqual(rendered[0], {"role": "system", "content": "sys static<tools>[{'name': 'tool'}]</tools>"})
+        self.assertEqual(rendered[1]['content'][0], {"type": "text", "text": "dynamic"})
+        self.assertIn("manual content", rendered[1]['content'][1]['text'])
+        self.assertEqual(rendered[3], {"role": "tool", "tool_call_id": "call_1", "content": "ok"})
+
+        # 旧 provider 缺少的新属性取默认值，刷新与更新正常
+        static = loaded.provider("static")
+        self.assertEqual(static.tags, frozenset())
+        self.assertFalse(static.swr)
+        static.update("changed")
+        loaded.provider("tools").mark_stale()
+        loaded.provider("tools").update([{"name": "other"}])
+        rendered = await loaded.render_latest()
+        self.assertEqual(rendered[0]['content'], "sys changed<tools>[{'name': 'other'}]</tools>")
+
+    async def test_zzz_save_falls_back_to_pickle(self):
+        """测试 JSON 编码器无法写出的值会回退到 pickle 保存"""
+        import pickle
+        test_file_path = "test_save_fallback.json"
+        messages = Messages(UserMessage(Texts("\udcff", name="surrogate"), Tools([{"max": 2 ** 70}])))
+        try:
+            messages.save(test_file_path)
+            with open(test_file_path, "rb") as f:
+                self.assertEqual(pickle.load(f).provider("surrogate").content, "\udcff")
+            loaded = Messages.load(test_file_path)
+            self.assertEqual(loaded.provider("tools")._tools_json, [{"max": 2 ** 70}])
+        finally:
+            if os.path.exists(test_file_path):
+                os.remove(test_file_path)
+
+    async def test_zzza_copy_message_with_parent(self):
+        """测试属于 Messages 的消息可以被 deepcopy 和 pickle"""
+        import copy
+        import pickle
+        shared = Texts("shared", name="shared")
+        messages = Messages(
+            UserMessage(Texts("first", name="first"), shared),
+            AssistantMessage("reply"),
+            UserMessage(Texts("last", name="last"), shared),
+        )
+        expected = await messages.render_latest()
+        for restore in (copy.deepcopy, lambda m: pickle.loads(pickle.dumps(m))):
+            message = restore(messages[2])
+            parent = message._parent_messages
+            self.assertIs(parent[2], message)
+            self.assertEqual(await parent.render_latest(), expected)
+            # 最后恢复的消息也在父对象的索引中，且索引顺序与消息顺序一致
+            self.assertIs(parent.provider("last"), message.provider("last"))
+            self.assertEqual(len(parent.provider("shared")), 2)
+            parent.pop("shared")
+            self.assertIsNone(parent[0].provider("shared"))
+            self.assertIsNotNone(message.provider("shared"))
+            parent.provider("last").update("changed")
+            rendered = await parent.render_latest()
+            self.assertEqual(rendered[2]['content'], "changedshared")
+
+    async def test_zzzb_files_refresh_read_errors(self):
+        """测试 Files.refresh 对 stat/读取错误内联错误信息，且修复后不依赖 mtime 变化即可重新读取"""
+        test_file = "test_refresh_errors.txt"
+        with open(test_file, "wb") as f:
+            f.write(b"\xff\xfe")
+        try:
+            # stat 本身失败（路径的上级不是目录）时不会让 refresh 抛出异常
+            bad_path = os.path.join(test_file, "child.txt")
+            files = Files(bad_path, test_file)
+            await files.refresh()
+            self.assertIn(f"[Error: Could not read file at path '{bad_path}'", files._cached_content)
+            self.assertIn(f"[Error: Could not read file at path '{test_file}'", files._cached_content)
+
+            # 修复内容但保持 mtime 与大小不变，下一次 refresh 仍会重新读取
+            st = os.stat(test_file)
+            with open(test_file, "wb") as f:
+                f.write(b"ok")
+            os.utime(test_file, ns=(st.st_atime_ns, st.st_mtime_ns))
+            await files.refresh()
+            self.assertIn("<file_content>ok</file_content>", files._cached_content)
+        finally:
+            os.remove(test_file)
+
+    async def test_zzzc_images_cancelled_refresh_keeps_cache_consistent(self):
+        """测试图片刷新在编码线程运行时被取消后，不会把旧内容当作新文件的缓存"""
+        import threading
+        from unittest.mock import patch
+        image_path = "test_image_cancel.png"
+        with open(image_path, "wb") as f:
+            f.write(b"first")
+        try:
+            image = Images(image_path)
+            await image.refresh()
+            with open(image_path, "wb") as f:
+                f.write(b"second!")
+            image.mark_stale()
+
+            release, finished = threading.Event(), threading.Event()
+            load = image._load_data_uri
+            def blocked_load():
+                release.wait()
+                try:
+                    return load()
+                finally:
+                    finished.set()
+            with patch.object(image, "_load_data_uri", blocked_load):
+                task = asyncio.create_task(image.refresh())
+                await asyncio.sleep(0.05)
+                task.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await task
+                release.set()
+                await asyncio.to_thread(finished.wait)
+
+            await image.refresh()
+            self.assertTrue(image._cached_content.endswith("c2Vjb25kIQ=="))
+        finally:
+            os.remove(image_path)
+
+    async def test_zzzd_files_read_survives_short_reads(self):
+        """测试单次 read 返回的字节少于请求时仍读取完整文件"""
+        from unittest.mock import patch
+        test_file = "test_short_reads.txt"
+        with open(test_file, "w", encoding="utf-8") as f:
+            f.write("第一行\n第二行\n")
+        empty_file = "test_short_reads_empty.txt"
+        open(empty_file, "w").close()
+        real_read = os.read
+        try:
+            with patch("os.read", lambda fd, n: real_read(fd, min(n, 5))):
+                files = Files(test_file, empty_file)
+            self.assertEqual(files._files[test_file], "第一行\n第二行\n")
+            self.assertEqual(files._files[empty_file], "")
+        finally:
+            os.remove(test_file)
+            os.remove(empty_file)
+
+    async def test_zzze_stale_while_revalidate_logs_failures(self):
+        """测试 swr 后台刷新失败时异常会被记录到日志，而不是在回收时才报出"""
+        class Failing(Texts):
+            async def render(self) -> Optional[str]:
+                raise RuntimeError("boom")
+
+        provider = Failing("old", name="failing", swr=True)
+        messages = Messages(UserMessage(provider))
+        provider.mark_stale()
+        with self.assertLogs(level="ERROR") as logs:
+            await messages.refresh()
+            task = provider._refresh_task
+            while not task.done():
+                await asyncio.sleep(0)
+            # done 回调在任务结束后的下一轮事件循环执行
+            await asyncio.sleep(0)
+        self.assertIn("Background refresh of provider 'failing' failed: boom", logs.output[0])
+        self.assertEqual(messages.render()[0]['content'], "old")
+        self.assertTrue(provider._is_stale)
+
 # ==============================================================================
 # 6. 演示
 # ==============================================================================